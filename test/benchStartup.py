@@ -0,0 +1,88 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+# Measures the startup cost of short lived tools: the time to import the backend
+# and the time to the first info() request against a local fake CouchDB server.
+#
+#   python test/benchStartup.py [runs]
+
+import subprocess, sys, os, time, json
+
+# run against this checkout, also when started as python test/benchStartup.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORT = "import time; t = time.time(); import wallaby.backends.couchdb; print time.time() - t"
+
+FIRST_INFO = """
+import time, sys
+t = time.time()
+from twisted.internet import reactor
+from wallaby.backends.couchdb import Database
+
+def run():
+    def done(info):
+        print time.time() - t
+        Database.closeConnections().addCallback(lambda _: reactor.stop())
+
+    db = Database.getDatabase('bench', url='http://127.0.0.1:%d' % int(sys.argv[1]))
+    db.info().addCallback(done)
+
+reactor.callWhenRunning(run)
+reactor.run()
+"""
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def measure(args, runs):
+    timings = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-W', 'ignore'] + args, cwd=ROOT)
+        timings.append(float(output.strip().split('\n')[-1]))
+    return median(timings)
+
+def startServer():
+    from twisted.web import server, resource
+    from twisted.internet import reactor
+
+    class FakeCouchDB(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('content-type', 'application/json')
+            return json.dumps({'db_name': 'bench', 'doc_count': 0, 'update_seq': 0})
+
+    port = reactor.listenTCP(0, server.Site(FakeCouchDB()), interface='127.0.0.1')
+    return port.getHost().port
+
+def main(runs=10):
+    print "import:              %.1f ms" % (measure(['-c', IMPORT], runs) * 1000)
+
+    # the fake server runs in this process' reactor thread, the clients in subprocesses
+    import threading
+    from twisted.internet import reactor
+
+    port = startServer()
+    thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+    thread.start()
+
+    try:
+        print "first info():        %.1f ms" % (measure(['-c', FIRST_INFO, str(port)], runs) * 1000)
+    finally:
+        reactor.callFromThread(reactor.stop)
+        thread.join()
+
+    from wallaby.backends.couchdb import Database
+
+    t = time.time()
+    for i in range(1000):
+        Database.getDatabase('bench%d' % i)
+    print "Database() x 1000:   %.1f ms" % ((time.time() - t) * 1000)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
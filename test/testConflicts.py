@@ -0,0 +1,123 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+from twisted.trial import unittest
+import json
+
+class FakeResponse(object):
+    def __init__(self, obj):
+        self._data = json.dumps(obj)
+        self.length = len(self._data)
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self._data)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+class FakeAgent(object):
+    # answers every request with the next response, request bodies are recorded
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+
+    def write(self, data):
+        self.bodies[-1] += data
+
+    @defer.inlineCallbacks
+    def request(self, method, url, headers=None, bodyProducer=None):
+        self.bodies.append("")
+        if bodyProducer != None:
+            yield bodyProducer.startProducing(self)
+
+        defer.returnValue(FakeResponse(self.responses.pop(0)))
+
+class WallabyConflictsTest(unittest.TestCase):
+    def setUp(self):
+        import wallaby.backends.couchdb as couch
+        self._couch = couch
+        self._url = "http://fake.conflicts:5984"
+        self._db = couch.Database("wallaby_test", url=self._url)
+
+        # ordered like resolve_conflicts passes them, the winning revision last
+        self._leafs = [
+            {"_id": "testdoc", "_rev": "2-aaaa", "a": 1, "text": "old",
+             "_attachments": {"lost.txt": {"stub": True, "revpos": 2}}},
+            {"_id": "testdoc", "_rev": "2-bbbb", "b": 2, "text": "new",
+             "_attachments": {"kept.txt": {"stub": True, "revpos": 1}}}
+        ]
+
+    def tearDown(self):
+        if self._url in self._couch.Database.agents:
+            del self._couch.Database.agents[self._url]
+
+    def fakeAgent(self, responses):
+        agent = FakeAgent(responses)
+        self._couch.Database.agents[self._url] = agent
+        return agent
+
+    @defer.inlineCallbacks
+    def test_resolverReturnsLeaf(self):
+        agent = self.fakeAgent([
+            [{"ok": leaf} for leaf in self._leafs],
+            [{"ok": True, "id": "testdoc", "rev": "3-cccc"}, {"ok": True, "id": "testdoc", "rev": "3-dddd"}]
+        ])
+
+        # returns the losing leaf itself, not a copy
+        merged = yield self._db.resolve_conflicts("testdoc", lambda docs: docs[0])
+
+        docs = json.loads(agent.bodies[1])["docs"]
+        self.assertEqual(docs[0]["_rev"], "2-bbbb")
+        self.assertEqual(docs[0]["_attachments"].keys(), ["kept.txt"])
+        self.assertEqual(docs[1], {"_id": "testdoc", "_rev": "2-aaaa", "_deleted": True})
+        self.assertEqual(merged["_rev"], "3-cccc")
+
+    @defer.inlineCallbacks
+    def test_failingResolver(self):
+        self.fakeAgent([[{"ok": leaf} for leaf in self._leafs]])
+
+        def fail(docs):
+            raise ValueError("cannot merge")
+
+        yield self.assertFailure(self._db.resolve_conflicts("testdoc", fail), ValueError)
+
+    @defer.inlineCallbacks
+    def test_failingResolverOnSave(self):
+        self.fakeAgent([
+            {"error": "conflict", "reason": "Document update conflict."},
+            {"_id": "testdoc", "_rev": "3-cccc", "text": "server"}
+        ])
+
+        def fail(docs):
+            raise ValueError("cannot merge")
+
+        self._db.setConflictResolver(fail)
+        doc = {"_id": "testdoc", "_rev": "2-bbbb", "text": "local"}
+
+        yield self.assertFailure(self._db.save(doc), ValueError)
+        self.assertEqual(doc["text"], "local")
+
+    def test_lastWriterWins(self):
+        merged = self._db._merge(self._leafs, "2-bbbb", self._couch.LastWriterWins())
+        self.assertFalse("a" in merged)
+        self.assertEqual(merged["text"], "new")
+
+    def test_fieldMerge(self):
+        merged = self._db._merge(self._leafs, "2-bbbb", self._couch.FieldMerge())
+        self.assertEqual((merged["a"], merged["b"], merged["text"]), (1, 2, "new"))
+        self.assertEqual(merged["_rev"], "2-bbbb")
+
+    def test_attachmentStubsOfWinnerOnly(self):
+        # stubs of a losing revision would be rejected with missing_stub
+        merged = self._db._merge(self._leafs, "2-bbbb", self._couch.ConflictResolver(lambda docs: dict(docs[0])))
+        self.assertEqual(merged["_attachments"].keys(), ["kept.txt"])
+
+    def test_inlineAttachmentsKept(self):
+        local = dict(self._leafs[0], _attachments={"new.txt": {"data": "SGVsbG8=", "content_type": "text/plain"}})
+        merged = self._db._merge([self._leafs[1], local], "2-bbbb", self._couch.FieldMerge())
+        self.assertEqual(sorted(merged["_attachments"].keys()), ["kept.txt", "new.txt"])
+
+    def test_resolverNeedsFunction(self):
+        self.assertRaises(TypeError, self._couch.ConflictResolver)
+        self.assertRaises(TypeError, self._couch.ConflictResolver, "not callable")
@@ -0,0 +1,52 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer, protocol
+from twisted.trial import unittest
+import json
+
+class FakeCouchDB(protocol.Protocol):
+    # drops the first request without answering, like a server closing an idle connection
+    def dataReceived(self, data):
+        if '\r\n\r\n' not in data: return
+
+        self.factory.requests += 1
+        if self.factory.requests == 1:
+            self.transport.loseConnection()
+        else:
+            body = json.dumps({"ok": True, "id": "testdoc", "rev": "1-a"})
+            self.transport.write("HTTP/1.1 201 Created\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+
+class WallabyConnectionsTest(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet import reactor
+        factory = protocol.Factory()
+        factory.protocol = FakeCouchDB
+        factory.requests = 0
+
+        self._factory = factory
+        self._port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+        import wallaby.backends.couchdb as couch
+        self._db = couch.Database("wallaby_test", url="http://127.0.0.1:%d" % self._port.getHost().port)
+
+    def tearDown(self):
+        import wallaby.backends.couchdb as couch
+        return defer.DeferredList([couch.Database.closeConnections(), defer.maybeDeferred(self._port.stopListening)])
+
+    @defer.inlineCallbacks
+    def test_retryDroppedRead(self):
+        info = yield self._db.info(returnOnError=True)
+
+        self.assertEqual(info["ok"], True)
+        self.assertEqual(self._factory.requests, 2)
+
+    @defer.inlineCallbacks
+    def test_droppedSaveNotRepeated(self):
+        # the server may have stored the document before dropping the connection
+        from twisted.web._newclient import ResponseNeverReceived
+        from wallaby.backends.couchdb import JSONProducer
+
+        save = self._db.request('PUT', path='testdoc', body=JSONProducer({"_id": "testdoc"}), returnOnError=True)
+        yield self.assertFailure(save, ResponseNeverReceived)
+        self.assertEqual(self._factory.requests, 1)
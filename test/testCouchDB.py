@@ -27,6 +27,10 @@ class WallabyCouchDBTest(unittest.TestCase):
         # self._db = couch.Database.getDatabase(self._dbName)
         # couch.Database.setURLForDatabase(self._dbName, "http://localhost:5984")
 
+    def tearDown(self):
+        import wallaby.backends.couchdb as couch
+        return couch.Database.closeConnections()
+
     @defer.inlineCallbacks
     def getDoc(self, name):
         doc = yield self._db.get(name)
@@ -175,6 +179,87 @@ class WallabyCouchDBTest(unittest.TestCase):
 
         self._db.unchanges(cb, since=seq, filter="wallaby_test/typeB")
 
+    @defer.inlineCallbacks
+    def test_10_bulkSave(self):
+        docs = {"docs": [{"_id": "bulk%d" % i, "type": "typeC"} for i in range(1000)]}
+        res = yield self._db.save(docs)
+
+        self.assertEqual(len(res), 1000)
+        self.assertTrue("_rev" in docs["docs"][-1])
+
+        doc = yield self.getDoc("bulk999")
+        self.assertEqual(doc["_rev"], docs["docs"][-1]["_rev"])
+
+    @defer.inlineCallbacks
+    def test_11_resolveConflicts(self):
+        docs = {"docs": [
+            {"_id": "conflictdoc", "_rev": "1-aaaa", "a": 1},
+            {"_id": "conflictdoc", "_rev": "1-bbbb", "b": 2}
+        ], "new_edits": False}
+        yield self._db.save(docs)
+
+        doc = yield self.getDoc("conflictdoc")
+        self.assertEqual(doc["_conflicts"], ["1-aaaa"])
+
+        import wallaby.backends.couchdb as couch
+        merged = yield self._db.resolve_conflicts("conflictdoc", couch.FieldMerge())
+        self.assertEqual(merged["a"], 1)
+        self.assertEqual(merged["b"], 2)
+
+        doc = yield self.getDoc("conflictdoc")
+        self.assertFalse("_conflicts" in doc)
+        self.assertEqual(doc["_rev"], merged["_rev"])
+
+    @defer.inlineCallbacks
+    def test_12_replicate(self):
+        import wallaby.backends.couchdb as couch
+        target = couch.Database(self._dbName + "_copy", url="http://localhost:5984")
+        yield target.create()
+
+        try:
+            stats = yield self._db.replicate(target, batchSize=100, parallel=2)
+            self.assertEqual(stats["errors"], 0)
+
+            info = yield self.getInfo()
+            copyInfo = yield target.info()
+            self.assertEqual(copyInfo["doc_count"], info["doc_count"])
+
+            # the checkpoint makes a second run a no-op
+            stats = yield self._db.replicate(target)
+            self.assertEqual(stats["docs_written"], 0)
+        finally:
+            yield target.destroy()
+
+    @defer.inlineCallbacks
+    def test_13_deployDesignDoc(self):
+        deployed = yield self._db.deploy_design_docs([self._designDoc])
+        self.assertEqual(deployed, [])
+
+        designDoc = dict(self._designDoc)
+        designDoc["views"] = dict(designDoc["views"])
+        designDoc["views"]["type"] = {"map": "function(doc) { if(doc.type)\n   emit(doc.type, null);\n}"}
+
+        reported = []
+        progress = lambda id, info: reported.append(info)
+
+        deployed = yield self._db.deploy_design_docs([designDoc], progress=progress, pollInterval=0.1)
+        self.assertEqual(deployed, ["_design/wallaby_test"])
+        self.assertEqual(reported[-1]["progress"], 100)
+
+        result = yield self._db.view("_design/wallaby_test/_view/type", key="typeB")
+        self.assertEqual(len(result), 1)
+
+    @defer.inlineCallbacks
+    def test_14_singleFlight(self):
+        hits = self._db.dedupStats()["hits"]
+
+        docs = yield defer.gatherResults([self._db.get(self._docId) for i in range(3)])
+        self.assertEqual(self._db.dedupStats()["hits"], hits + 2)
+
+        self.assertEqual(docs[0], docs[1])
+        docs[0]["text"] = "Modified"
+        self.assertNotEqual(docs[1]["text"], "Modified")
+
     @defer.inlineCallbacks
     def test_98_deleteDoc(self):
         doc = yield self.getDoc(self._docId)
@@ -0,0 +1,76 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import task
+from twisted.trial import unittest
+import json
+
+class FakeConsumer(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class WallabyJSONProducerTest(unittest.TestCase):
+    def setUp(self):
+        # one producer step per scheduled call, run by step()
+        self._scheduled = []
+        self._cooperator = task.Cooperator(lambda: (lambda: True), self._scheduled.append)
+
+        self._bulk = {"docs": [{"_id": "doc%d" % i, "text": u"\xe4" * 20} for i in range(50)], "new_edits": False}
+        self._consumer = FakeConsumer()
+
+    def producer(self, obj):
+        from wallaby.backends.couchdb import JSONProducer
+        producer = JSONProducer(obj, cooperator=self._cooperator)
+        producer.Chunksize = 100
+        return producer
+
+    def step(self):
+        while len(self._scheduled) > 0:
+            self._scheduled.pop(0)()
+
+    def test_chunks(self):
+        finished = []
+        self.producer(self._bulk).startProducing(self._consumer).addCallback(finished.append)
+        self.step()
+
+        self.assertEqual(finished, [None])
+        self.assertEqual(set(len(chunk) for chunk in self._consumer.chunks[:-1]), set([100]))
+        self.assertTrue(len(self._consumer.chunks[-1]) <= 100)
+        self.assertEqual(json.loads("".join(self._consumer.chunks)), self._bulk)
+
+    def test_singleDocument(self):
+        doc = {"_id": "doc", "text": "x" * 250}
+        self.producer(doc).startProducing(self._consumer)
+        self.step()
+
+        self.assertEqual([len(chunk) for chunk in self._consumer.chunks[:-1]], [100, 100])
+        self.assertEqual(json.loads("".join(self._consumer.chunks)), doc)
+
+    def test_pauseResume(self):
+        producer = self.producer(self._bulk)
+        producer.startProducing(self._consumer)
+        self._scheduled.pop(0)()
+        self.assertEqual(len(self._consumer.chunks), 1)
+
+        producer.pauseProducing()
+        self.step()
+        self.assertEqual(len(self._consumer.chunks), 1)
+
+        producer.resumeProducing()
+        self.step()
+        self.assertEqual(json.loads("".join(self._consumer.chunks)), self._bulk)
+
+    def test_stopProducing(self):
+        finished = []
+        producer = self.producer(self._bulk)
+        producer.startProducing(self._consumer).addBoth(finished.append)
+        self._scheduled.pop(0)()
+
+        producer.stopProducing()
+        self.step()
+
+        self.assertEqual(len(self._consumer.chunks), 1)
+        self.assertEqual(finished, [])
@@ -0,0 +1,151 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+class FakeTransport(object):
+    def __init__(self):
+        self.paused = False
+        self.pauses = 0
+        self.resumes = 0
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pauses += 1
+
+    def resumeProducing(self):
+        self.paused = False
+        self.resumes += 1
+
+def change(seq, id):
+    return {"seq": seq, "id": id, "changes": [{"rev": "%d-a" % seq}]}
+
+def settle():
+    # workers are started with callLater(0)
+    from twisted.internet import reactor
+    return task.deferLater(reactor, 0, lambda: None)
+
+class WallabyPoolTest(unittest.TestCase):
+    def setUp(self):
+        from wallaby.backends.couchdb import ChangesConsumerPool
+        self._transport = FakeTransport()
+
+        # with two workers docA is sharded onto worker 1 and docD onto worker 0
+        self._pool = ChangesConsumerPool(workers=2, maxPending=4)
+        self._pool.setTransport(self._transport)
+
+        self._running = []
+        self._processed = []
+
+    def callback(self, change, viewID=None):
+        d = defer.Deferred()
+        d.addCallback(lambda _: self._processed.append(change["seq"]))
+        self._running.append((change["seq"], d))
+        return d
+
+    def finish(self, seq):
+        for i, (running, d) in enumerate(self._running):
+            if running == seq:
+                del self._running[i]
+                d.callback(None)
+                return
+        self.fail("change %d is not running" % seq)
+
+    @defer.inlineCallbacks
+    def test_documentOrder(self):
+        self._pool.put(change(1, "docA"), [self.callback])
+        self._pool.put(change(2, "docA"), [self.callback])
+        yield settle()
+
+        # the second change of docA waits for the first one
+        self.assertEqual([seq for seq, d in self._running], [1])
+
+        self.finish(1)
+        self.assertEqual([seq for seq, d in self._running], [2])
+        self.finish(2)
+        self.assertEqual(self._processed, [1, 2])
+
+    @defer.inlineCallbacks
+    def test_parallelDocuments(self):
+        ids = ["docA", "docB", "docC", "docD"]
+        for seq, id in enumerate(ids):
+            self._pool.put(change(seq + 1, id), [self.callback])
+        yield settle()
+
+        # one running change per worker
+        self.assertEqual(len(self._running), 2)
+
+    @defer.inlineCallbacks
+    def test_backpressure(self):
+        for seq in range(1, 4):
+            self._pool.put(change(seq, "docA"), [self.callback])
+        self.assertFalse(self._transport.paused)
+
+        self._pool.put(change(4, "docA"), [self.callback])
+        self.assertTrue(self._transport.paused)
+        self.assertTrue(self._pool.paused())
+        yield settle()
+
+        self.finish(1)
+        self.assertTrue(self._transport.paused)
+
+        # resumed at maxPending / 2
+        self.finish(2)
+        self.assertFalse(self._transport.paused)
+        self.assertEqual((self._transport.pauses, self._transport.resumes), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_lag(self):
+        self.assertEqual(self._pool.lag(), 0)
+
+        self._pool.put(change(10, "docA"), [self.callback])
+        self._pool.put(change(11, "docD"), [self.callback])
+        self._pool.put(change(12, "docA"), [self.callback])
+        self.assertEqual(self._pool.lag(), 3)
+        yield settle()
+
+        # seq 11 is done, but 10 is not, so nothing counts as processed yet
+        self.finish(11)
+        self.assertEqual(self._pool.processedSeq(), None)
+
+        self.finish(10)
+        self.assertEqual(self._pool.processedSeq(), 11)
+        self.assertEqual(self._pool.lag(), 1)
+
+        self.finish(12)
+        self.assertEqual(self._pool.processedSeq(), 12)
+        self.assertEqual(self._pool.lag(), 0)
+
+    @defer.inlineCallbacks
+    def test_lagFromSince(self):
+        from wallaby.backends.couchdb import ChangesConsumerPool
+        pool = ChangesConsumerPool(workers=2, maxPending=4)
+        pool.setTransport(FakeTransport(), since="5-opaque")
+
+        # filtered feeds skip sequences, the lag still counts from since
+        pool.put(change(10, "docA"), [self.callback])
+        self.assertEqual(pool.lag(), 5)
+        yield settle()
+
+        self.finish(10)
+        self.assertEqual(pool.lag(), 0)
+
+    @defer.inlineCallbacks
+    def test_stopAndReuse(self):
+        self._pool.put(change(1, "docA"), [self.callback])
+        self._pool.put(change(2, "docD"), [self.callback])
+        yield settle()
+
+        self._pool.stop()
+        self.finish(1)
+        self.finish(2)
+        self.assertEqual(self._pool.pending(), 0)
+
+        self._pool.setTransport(FakeTransport())
+        self._pool.put(change(3, "docA"), [self.callback])
+        yield settle()
+
+        self.finish(3)
+        self.assertEqual(self._pool.processedSeq(), 3)
+        self.assertEqual(self._pool.pending(), 0)
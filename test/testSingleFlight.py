@@ -0,0 +1,77 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+from twisted.trial import unittest
+import json
+
+class FakeResponse(object):
+    def __init__(self, obj):
+        self._data = json.dumps(obj)
+        self.length = len(self._data)
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self._data)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+class FakeAgent(object):
+    # answers requests only when the test calls respond()
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+    def respond(self, index, obj):
+        self.requests[index][2].callback(FakeResponse(obj))
+
+class WallabySingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        import wallaby.backends.couchdb as couch
+        self._url = "http://fake.singleflight:5984"
+        self._agent = FakeAgent()
+        couch.Database.agents[self._url] = self._agent
+        self._db = couch.Database("wallaby_test", url=self._url)
+
+    def tearDown(self):
+        import wallaby.backends.couchdb as couch
+        del couch.Database.agents[self._url]
+
+    def test_sharedRead(self):
+        d1 = self._db.get("testdoc")
+        d2 = self._db.get("testdoc")
+        self.assertEqual(len(self._agent.requests), 1)
+
+        self._agent.respond(0, {"_id": "testdoc", "_rev": "1-a", "list": [1]})
+
+        doc1 = self.successResultOf(d1)
+        doc2 = self.successResultOf(d2)
+        self.assertEqual(doc1, doc2)
+
+        doc1["list"].append(2)
+        self.assertEqual(doc2["list"], [1])
+        self.assertEqual(self._db.dedupStats(), {"hits": 1, "misses": 1, "inflight": 0})
+
+    def test_readWriteRead(self):
+        before = self._db.get("testdoc")
+
+        doc = {"_id": "testdoc", "_rev": "1-a", "text": "new"}
+        saved = self._db.save(doc)
+        self.assertEqual(len(self._agent.requests), 2)
+        self._agent.respond(1, {"ok": True, "id": "testdoc", "rev": "2-b"})
+        self.successResultOf(saved)
+
+        # issued after the save completed, must not join the read from before it
+        after = self._db.get("testdoc")
+        self.assertEqual(len(self._agent.requests), 3)
+
+        self._agent.respond(0, {"_id": "testdoc", "_rev": "1-a", "text": "old"})
+        self._agent.respond(2, {"_id": "testdoc", "_rev": "2-b", "text": "new"})
+
+        self.assertEqual(self.successResultOf(before)["_rev"], "1-a")
+        self.assertEqual(self.successResultOf(after)["_rev"], "2-b")
+        self.assertEqual(self._db.dedupStats()["hits"], 0)
@@ -1,18 +1,19 @@
 # Copyright (c) by it's authors.
 # Some rights reserved. See LICENSE, AUTHORS.
 
-from twisted.web import client
-from twisted.web.client import Agent
 from twisted.internet import defer
 from twisted.web.http_headers import Headers
 from twisted.internet.protocol import Protocol
-from twisted.web._newclient import ResponseFailed, ResponseDone
+from twisted.web._newclient import ResponseFailed, ResponseDone, RequestNotSent, RequestTransmissionFailed, ResponseNeverReceived
+from twisted.internet import task
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
 from twisted.python.failure import Failure
+from zope.interface import implements
 import urllib, json, base64, copy
 
 from wallaby.backends.http import JSONProtocol, DataProducer, WebClientContextFactory, UnknownError, RawProtocol
-
-client._HTTP11ClientFactory.noisy = False
+from wallaby.backends.couchdb.conflicts import ConflictResolver, LastWriterWins, FieldMerge, revisionKey
+from wallaby.backends.couchdb.pool import ChangesConsumerPool
 
 class DocumentUpdateConflict(UnknownError):
     pass
@@ -72,6 +73,76 @@ class ChangesProtocol(Protocol):
         # from twisted.internet import reactor
         # reactor.callLater(0, self._db.changes, self._id)
 
+class JSONProducer(object):
+    implements(IBodyProducer)
+    Chunksize = 65536
+
+    def __init__(self, obj, cooperator=task):
+        self._obj = obj
+        self._cooperate = cooperator.cooperate
+        self.length = UNKNOWN_LENGTH
+        self._task = None
+
+    def _fragments(self):
+        obj = self._obj
+
+        if isinstance(obj, dict) and isinstance(obj.get('docs'), list):
+            # encode bulk payloads one document at a time
+            yield '{'
+            for key, value in obj.items():
+                if key != 'docs':
+                    yield json.dumps(key) + ': ' + json.dumps(value) + ', '
+
+            yield '"docs": ['
+            for i, doc in enumerate(obj['docs']):
+                if i > 0: yield ', '
+                yield json.dumps(doc)
+            yield ']}'
+        else:
+            yield json.dumps(obj)
+
+    def _write(self, consumer):
+        buf = []
+        size = 0
+        for fragment in self._fragments():
+            buf.append(fragment)
+            size += len(fragment)
+
+            if size < self.Chunksize: continue
+
+            data = ''.join(buf)
+            pos = 0
+            while len(data) - pos >= self.Chunksize:
+                consumer.write(data[pos:pos+self.Chunksize])
+                pos += self.Chunksize
+                yield None
+
+            buf = [data[pos:]]
+            size = len(buf[0])
+
+        if size > 0:
+            consumer.write(''.join(buf))
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._write(consumer))
+
+        d = self._task.whenDone()
+        def maybeStopped(reason):
+            # stopProducing was called, the transport does not expect a result
+            reason.trap(task.TaskStopped)
+            return defer.Deferred()
+        d.addCallbacks(lambda ignored: None, maybeStopped)
+        return d
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
+
 class Closer(Protocol):
     def makeConnection(self, producer):
         producer.stopProducing()
@@ -83,6 +154,35 @@ class Database(object):
     databases = {}
     defaultDB = None
 
+    agents = {}
+    pools = {}
+    contextFactory = None
+
+    @staticmethod
+    def getAgent(url):
+        # twisted.web.client installs the reactor, so only import it on the first request
+        if url not in Database.agents:
+            from twisted.web import client
+            from twisted.internet import reactor
+            client._HTTP11ClientFactory.noisy = False
+
+            if Database.contextFactory == None:
+                Database.contextFactory = WebClientContextFactory()
+
+            Database.pools[url] = client.HTTPConnectionPool(reactor, persistent=True)
+            Database.agents[url] = client.Agent(reactor, Database.contextFactory, pool=Database.pools[url])
+
+        return Database.agents[url]
+
+    @staticmethod
+    def closeConnections():
+        # close all idle keep-alive connections, e.g. before stopping the reactor
+        pools = Database.pools.values()
+        Database.pools = {}
+        Database.agents = {}
+
+        return defer.DeferredList([pool.closeCachedConnections() for pool in pools])
+
     @staticmethod
     def setURLForDatabase(databaseName, url):
         database = Database.getDatabase(databaseName)
@@ -164,30 +264,38 @@ class Database(object):
     def destroy(self):
         return self.request('DELETE', "", body=DataProducer(""))
 
-    def __init__(self, name, user=None, password=None, url='http://localhost:5984'):
+    def __init__(self, name, user=None, password=None, url='http://localhost:5984', conflictResolver=None, singleFlight=True):
         self._url = url
         self._name = name
         self._changesCBs = {}
         self._failedRequests = []
         self._changesRunning = {}
         self._changesProtocols = {}
+        self._changesPools = {}
         self._lastSeq = {}
         self._connectionStatusCallbacks = []
         self._connected = False
         self._user = None
         self._password = None
         self._authHeader = None
+        self._conflictResolver = None
+        self._singleFlight = singleFlight
+        self._inflight = {}
+        self._dedupHits = 0
+        self._dedupMisses = 0
+
+        if conflictResolver != None:
+            self.setConflictResolver(conflictResolver)
 
         if user != None and password != None:
             self.setCredentials(user, password)
 
-        self._contextFactory = WebClientContextFactory()
-        from twisted.internet import reactor
-        self._agent = Agent(reactor, self._contextFactory)
-
     def name(self):
         return self._name
 
+    def agent(self):
+        return Database.getAgent(self._url)
+
     def proto(self):
         if not self._url: return None
 
@@ -225,6 +333,17 @@ class Database(object):
             basicAuth = base64.encodestring('%s:%s' % (username, password))
             self._authHeader = "Basic " + basicAuth.strip()
 
+    def setConflictResolver(self, resolver=None):
+        self._conflictResolver = self._resolver(resolver)
+
+    def conflictResolver(self):
+        return self._conflictResolver
+
+    def _resolver(self, resolver):
+        if resolver != None and not isinstance(resolver, ConflictResolver):
+            resolver = ConflictResolver(resolver)
+        return resolver
+
     def addConnectionStatusCallback(self, connectionStatusCallback):
         if connectionStatusCallback not in self._connectionStatusCallbacks:
             self._connectionStatusCallbacks.append(connectionStatusCallback)
@@ -236,19 +355,56 @@ class Database(object):
                 connectionStatusCallback(connected)
 
     def request(self, method, path=None, body=None, headers=None, protocol=JSONProtocol, **ka):
-        if headers == None and self._authHeader:
-            headers = {"Authorization": [self._authHeader]}
-        elif headers != None and self._authHeader:
-            headers["Authorization"] = [self._authHeader]
+        headers = self._headers(headers)
 
         d = defer.Deferred()
-        from twisted.internet import reactor
-        reactor.callLater(0, self._request, d, method, path, body, headers, protocol, **ka)
+
+        # identical concurrent reads share one request
+        if self._singleFlight and method == 'GET' and body == None:
+            key = json.dumps([path, headers, ka, protocol.__name__], sort_keys=True, default=str)
+
+            if key in self._inflight:
+                self._dedupHits += 1
+                self._inflight[key].append(d)
+                return d
+
+            self._dedupMisses += 1
+            waiting = []
+            self._inflight[key] = waiting
+            d.addBoth(self._landed, key, waiting)
+        elif method != 'GET':
+            # reads issued after a write must not see a response from before it
+            self._inflight = {}
+            d.addBoth(self._written)
+
+        self._request(d, method, path, body, headers, protocol, **ka)
         return d
 
-    @defer.inlineCallbacks
-    def _request(self, d, method, path, body, headers, protocol, keepOnTrying=False, returnOnError=False, **ka):
-        url = self._url+"/"+self._name
+    def _written(self, result):
+        self._inflight = {}
+        return result
+
+    def _landed(self, result, key, waiting):
+        if self._inflight.get(key) is waiting:
+            del self._inflight[key]
+
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                # every caller gets its own copy to modify
+                d.callback(copy.deepcopy(result))
+
+        return result
+
+    def dedupStats(self):
+        return {'hits': self._dedupHits, 'misses': self._dedupMisses, 'inflight': len(self._inflight)}
+
+    def _buildURL(self, path=None, server=False, **ka):
+        if server:
+            url = self._url
+        else:
+            url = self._url+"/"+self._name
         if path:
             url += "/"+path
 
@@ -261,9 +417,22 @@ class Database(object):
                 else:
                     kv[k] = json.dumps(v)
             url += '?'+urllib.urlencode(kv)
+
+        return url
+
+    def _headers(self, headers=None):
+        if headers == None:
+            headers = {}
+        if self._authHeader:
+            headers["Authorization"] = [self._authHeader]
+        return headers
+
+    @defer.inlineCallbacks
+    def _request(self, d, method, path, body, headers, protocol, keepOnTrying=False, returnOnError=False, retried=False, **ka):
+        url = self._buildURL(path, **ka)
         try:
             #print "REQUEST", method, str(url), body, headers, Headers(headers)
-            response = yield self._agent.request(method, str(url), headers=Headers(headers), bodyProducer=body)
+            response = yield self.agent().request(method, str(url), headers=Headers(headers), bodyProducer=body)
 
             responseDeferred = defer.Deferred()
             response.deliverBody(protocol(responseDeferred, response.length))
@@ -271,7 +440,13 @@ class Database(object):
 
             d.callback(responseData)
         except (Exception,Failure) as e:
-            if keepOnTrying: #  or self._changesRunning:
+            if not retried and (isinstance(e, RequestNotSent) or (method in ('GET', 'HEAD') and isinstance(e, (RequestTransmissionFailed, ResponseNeverReceived)))):
+                # the server closed the pooled connection while it was idle. Other requests
+                # might have been handled by the server already and are not sent twice
+                if isinstance(body, DataProducer):
+                    body = DataProducer(body.body)
+                self._request(d, method, path, body, headers, protocol, keepOnTrying=keepOnTrying, returnOnError=returnOnError, retried=True, **ka)
+            elif keepOnTrying: #  or self._changesRunning:
                 from twisted.internet import reactor
                 reactor.callLater(1, self._request, d, method, path, body, headers, protocol, **ka)
             elif returnOnError:
@@ -318,16 +493,14 @@ class Database(object):
     def get(self, id, rev=None):
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._get, id, d, rev=rev)
+        self._get(id, d, rev=rev)
 
         return d
 
     def get_with_attachments(self, id, rev=None):
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._get_with_attachments, id, d, rev=rev)
+        self._get_with_attachments(id, d, rev=rev)
 
         return d
 
@@ -360,6 +533,9 @@ class Database(object):
     def info(self, **ka):
         return self.request('GET', **ka)
 
+    def active_tasks(self, **ka):
+        return self.request('GET', path='_active_tasks', server=True, **ka)
+
     def __error(self):
         d = defer.Deferred()
         d.errback("Assertion failed")
@@ -372,25 +548,46 @@ class Database(object):
 
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._save, doc, d, **ka)
+        self._save(doc, d, **ka)
 
         return d
 
     @defer.inlineCallbacks
-    def _save(self, doc, d, **ka):
-        jsonString = json.dumps(doc)
-
+    def _save(self, doc, d, resolve=True, **ka):
         if '_id' in doc:
-            response = yield self.request('PUT', path=urllib.quote(doc['_id'], ""), body=DataProducer(jsonString), **ka)
+            response = yield self.request('PUT', path=urllib.quote(doc['_id'], ""), body=JSONProducer(doc), **ka)
         elif 'docs' in doc:
-            response = yield self.request('POST', path='_bulk_docs', headers={'Content-Type': ['application/json']}, body=DataProducer(jsonString), **ka)
+            response = yield self.request('POST', path='_bulk_docs', headers={'Content-Type': ['application/json']}, body=JSONProducer(doc), **ka)
 
         if 'rev' in response:
             doc['_rev'] = response['rev']
             d.callback(response)
         elif 'error' in response:
             if response['error'] == 'conflict':
+                if resolve and '_id' in doc and self._conflictResolver != None:
+                    current = yield self.get(doc['_id'])
+
+                    if current != None:
+                        try:
+                            merged = self._merge([current, doc], current['_rev'], self._conflictResolver)
+                        except (Exception,Failure) as e:
+                            d.errback(e)
+                            return
+
+                        mergedDeferred = defer.Deferred()
+                        self._save(merged, mergedDeferred, resolve=False, **ka)
+
+                        try:
+                            response = yield mergedDeferred
+                        except (Exception,Failure) as e:
+                            d.errback(e)
+                            return
+
+                        doc.clear()
+                        doc.update(merged)
+                        d.callback(response)
+                        return
+
                 if '_id' in doc: response['_id'] = doc['_id']
                 if '_rev' in doc: response['_rev'] = doc['_rev']
                 e = DocumentUpdateConflict(response)
@@ -408,20 +605,87 @@ class Database(object):
 
             d.callback(response)
 
+    def _merge(self, docs, rev, resolver):
+        # resolvers may return one of the documents passed in
+        merged = copy.deepcopy(resolver.resolve(docs))
+        merged['_id'] = docs[-1]['_id']
+        merged['_rev'] = rev
+        if '_conflicts' in merged: del merged['_conflicts']
+
+        # attachment stubs are only valid for the revision that is updated,
+        # new inline attachments of other revisions are kept
+        attachments = {}
+        for doc in docs:
+            if doc.get('_rev') == rev:
+                attachments.update(copy.deepcopy(doc.get('_attachments', {})))
+
+        for filename, attachment in merged.get('_attachments', {}).items():
+            if not attachment.get('stub', False) and filename not in attachments:
+                attachments[filename] = attachment
+
+        if len(attachments) > 0:
+            merged['_attachments'] = attachments
+        elif '_attachments' in merged:
+            del merged['_attachments']
+
+        return merged
+
+    def resolve_conflicts(self, id, resolver=None):
+        resolver = self._resolver(resolver) or self._conflictResolver
+        if resolver == None: resolver = LastWriterWins()
+
+        d = defer.Deferred()
+
+        self._resolve_conflicts(id, resolver, d)
+
+        return d
+
+    @defer.inlineCallbacks
+    def _resolve_conflicts(self, id, resolver, d):
+        # fetch all leaf revisions in one request
+        response = yield self.request('GET', path=urllib.quote(id, "")+'?open_revs=all', headers={'Accept': ['application/json']})
+
+        if 'error' in response:
+            d.errback(UnknownError(response))
+            return
+
+        leafs = [r['ok'] for r in response if 'ok' in r and not r['ok'].get('_deleted', False)]
+
+        if len(leafs) < 2:
+            d.callback(None)
+            return
+
+        leafs.sort(key=revisionKey)
+        deleted = [{'_id': id, '_rev': leaf['_rev'], '_deleted': True} for leaf in leafs[:-1]]
+
+        try:
+            merged = self._merge(leafs, leafs[-1]['_rev'], resolver)
+        except (Exception,Failure) as e:
+            d.errback(e)
+            return
+
+        # write the winner and delete the losers in one go
+        docs = [merged] + deleted
+        response = yield self.request('POST', path='_bulk_docs', headers={'Content-Type': ['application/json']}, body=JSONProducer({'docs': docs}))
+
+        if 'error' in response or len([r for r in response if 'error' in r]) > 0:
+            d.errback(DocumentUpdateConflict(response))
+            return
+
+        merged['_rev'] = response[0]['rev']
+        d.callback(merged)
+
     def delete(self, doc):
         if not self.assertIsDoc(doc): return self.__error()
 
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._delete, doc, d)
+        self._delete(doc, d)
 
         return d
 
     @defer.inlineCallbacks
     def _delete(self, doc, d):
-        jsonString = json.dumps(doc)
-
         response = yield self.request('DELETE', path=urllib.quote(doc['_id'], ""), rev=doc['_rev'])
 
         if 'error' in response:
@@ -444,8 +708,7 @@ class Database(object):
 
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._put_attachment, doc, filename, data, contentType, d)
+        self._put_attachment(doc, filename, data, contentType, d)
 
         return d
 
@@ -460,8 +723,7 @@ class Database(object):
     def view(self, name, **ka):
         d = defer.Deferred()
 
-        from twisted.internet import reactor
-        reactor.callLater(0, self._view, name, d, **ka)
+        self._view(name, d, **ka)
 
         return d
 
@@ -484,6 +746,12 @@ class Database(object):
         else:
             d.errback(ViewError((response,name)))
 
+    def replicate(self, target, **ka):
+        return Replicator(self, target, **ka).run()
+
+    def deploy_design_docs(self, docs, progress=None, **ka):
+        return DesignDocManager(self, **ka).deploy(docs, progress=progress)
+
     def removeCallbacks(self, __id, close=True):
         # Wake up pending callbacks
         for cb in self._changesCBs[__id]:
@@ -494,6 +762,11 @@ class Database(object):
         del self._changesRunning[__id]
         del self._lastSeq[__id]
 
+        if self._changesPools[__id] is not None:
+            self._changesPools[__id].stop()
+
+        del self._changesPools[__id]
+
         if self._changesProtocols[__id] is not None and close:
             self._changesProtocols[__id].close()
 
@@ -511,7 +784,7 @@ class Database(object):
             self.removeCallbacks(__id)
 
     @defer.inlineCallbacks
-    def changes(self, cb=None, since=None, filter=None, view=None, redo=False):
+    def changes(self, cb=None, since=None, filter=None, view=None, redo=False, pool=None):
         # TODO: add since to identifier
         __id = str(filter) + "__" + str(view)
 
@@ -524,6 +797,10 @@ class Database(object):
             self._changesRunning[__id] = False
             self._lastSeq[__id] = None
             self._changesProtocols[__id] = None
+            self._changesPools[__id] = None
+
+        if pool:
+            self._changesPools[__id] = pool
 
         if cb:
             if cb not in self._changesCBs[__id]:
@@ -556,14 +833,12 @@ class Database(object):
             if filter != None: url += "&filter=" + str(filter)
             if view != None: url += "&view=" + str(view)
 
-            headers = {'User-Agent': ['Couchdb testclient'], 'Content-Type': ['text/x-greeting']}
-            if self._authHeader:
-                headers["Authorization"] = [self._authHeader]
+            headers = self._headers({'User-Agent': ['Couchdb testclient'], 'Content-Type': ['text/x-greeting']})
 
             try:
                 self._changesRunning[__id] = True
 
-                response = yield self._agent.request(
+                response = yield self.agent().request(
                     'GET',
                     url,
                     Headers(headers), None)
@@ -578,6 +853,9 @@ class Database(object):
                 p = ChangesProtocol(self, __id)
                 response.deliverBody(p)
                 self._changesProtocols[__id] = p
+
+                if self._changesPools[__id] is not None:
+                    self._changesPools[__id].setTransport(p.transport, since=self._lastSeq[__id])
                 # print "START changes stream", url
             except Exception as e:
                 print e
@@ -590,6 +868,12 @@ class Database(object):
     def _newChange(self, id, change):
         if 'last_seq' in change:
             self._lastSeq[id] = change['last_seq']
+        elif self._changesPools[id] is not None:
+            self._changesPools[id].put(change, self._changesCBs[id], viewID=id)
         else:
             for cb in self._changesCBs[id]:
                 cb(change, viewID=id)
+
+# the replicator and design doc manager build on Database and JSONProducer defined above
+from wallaby.backends.couchdb.replication import Replicator, ReplicationError
+from wallaby.backends.couchdb.design import DesignDocManager, DesignDocError
@@ -0,0 +1,37 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+import copy
+
+def revisionKey(doc):
+    # CouchDB picks the winning revision by generation first, then by hash
+    num, _, hash = doc['_rev'].partition('-')
+    return (int(num), hash)
+
+class ConflictResolver(object):
+    # docs are passed ordered from the oldest to the latest writer, the
+    # returned document is saved as the new winning revision
+    def __init__(self, func=None):
+        if func == None and type(self).resolve == ConflictResolver.resolve:
+            raise TypeError("ConflictResolver needs a resolve function")
+        if func != None and not callable(func):
+            raise TypeError("resolve function is not callable: %r" % (func,))
+
+        self._func = func
+
+    def resolve(self, docs):
+        return self._func(docs)
+
+class LastWriterWins(ConflictResolver):
+    def resolve(self, docs):
+        return copy.deepcopy(docs[-1])
+
+class FieldMerge(ConflictResolver):
+    def resolve(self, docs):
+        # union of all fields, later writers win on fields present in both
+        merged = {}
+        for doc in docs:
+            for key, value in doc.items():
+                merged[key] = copy.deepcopy(value)
+
+        return merged
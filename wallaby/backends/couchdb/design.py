@@ -0,0 +1,207 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer, task
+import urllib, time
+
+from wallaby.backends.http import UnknownError
+from wallaby.backends.couchdb import JSONProducer
+from wallaby.backends.couchdb.pool import seqNumber
+
+class DesignDocError(UnknownError):
+    pass
+
+class DesignDocManager(object):
+    Ignore = ('_id', '_rev', '_conflicts', 'wallabyUser')
+
+    def __init__(self, db, stagingSuffix='_staging', pollInterval=1.0):
+        self._db = db
+        self._stagingSuffix = stagingSuffix
+        self._pollInterval = pollInterval
+        self._progress = {}
+
+    def _name(self, id):
+        if id.startswith('_design/'): id = id[len('_design/'):]
+        return id
+
+    def _path(self, name):
+        return '_design/' + urllib.quote(name, '')
+
+    def _content(self, doc):
+        content = {}
+        for key, value in doc.items():
+            if key not in DesignDocManager.Ignore:
+                content[key] = value
+        return content
+
+    @defer.inlineCallbacks
+    def _fetch(self, name):
+        response = yield self._db.request('GET', path=self._path(name))
+
+        if 'error' in response:
+            defer.returnValue(None)
+
+        defer.returnValue(response)
+
+    @defer.inlineCallbacks
+    def diff(self, docs):
+        changed = []
+        for doc in docs:
+            remote = yield self._fetch(self._name(doc['_id']))
+
+            if remote == None or self._content(remote) != self._content(doc):
+                changed.append(doc)
+
+        defer.returnValue(changed)
+
+    @defer.inlineCallbacks
+    def deploy(self, docs, progress=None):
+        changed = yield self.diff(docs)
+
+        deployed = []
+        for doc in changed:
+            yield self._deploy(doc, progress)
+            deployed.append(doc['_id'])
+
+        defer.returnValue(deployed)
+
+    @defer.inlineCallbacks
+    def _deploy(self, doc, progress):
+        name = self._name(doc['_id'])
+        stagingName = name + self._stagingSuffix
+
+        staging = self._content(doc)
+        staging['_id'] = '_design/' + stagingName
+
+        current = yield self._fetch(stagingName)
+        if current != None:
+            staging['_rev'] = current['_rev']
+
+        response = yield self._db.request('PUT', path=self._path(stagingName), body=JSONProducer(staging))
+        if 'error' in response:
+            raise DesignDocError(response)
+
+        staging['_rev'] = response['rev']
+
+        views = doc.get('views', {}).keys()
+        if len(views) > 0:
+            yield self._build(stagingName, views[0], progress)
+
+        # the index is built, the live document shares its signature with the staging one
+        current = yield self._fetch(name)
+
+        destination = '_design/' + name
+        if current != None:
+            destination += '?rev=' + current['_rev']
+
+        response = yield self._db.request('COPY', path=self._path(stagingName), headers={'Destination': [destination]})
+        if 'error' in response:
+            raise DesignDocError(response)
+
+        response = yield self._db.request('DELETE', path=self._path(stagingName), rev=staging['_rev'])
+        if 'error' in response:
+            raise DesignDocError(response)
+
+        if staging['_id'] in self._progress:
+            del self._progress[staging['_id']]
+
+    @defer.inlineCallbacks
+    def _build(self, name, view, progress):
+        viewPath = self._path(name) + '/_view/' + urllib.quote(view, '')
+        id = '_design/' + name
+
+        info = yield self._db.info()
+        if 'error' in info:
+            raise DesignDocError(info)
+
+        # the index is built once it has caught up with the database as of now
+        targetSeq = seqNumber(info['update_seq'])
+        startedOn = time.time()
+        startSeq = None
+
+        from twisted.internet import reactor
+
+        while True:
+            info = yield self._db.request('GET', path=self._path(name) + '/_info')
+            if 'error' in info:
+                raise DesignDocError(info)
+
+            indexSeq = seqNumber(info['view_index']['update_seq'])
+            running = info['view_index'].get('updater_running', False)
+
+            if indexSeq >= targetSeq and not running:
+                break
+
+            if not running:
+                # stale=update_after starts the indexer after responding, without waiting for it
+                response = yield self._db.request('GET', path=viewPath + '?limit=0&stale=update_after')
+                if 'error' in response:
+                    raise DesignDocError(response)
+
+            if startSeq == None:
+                startSeq = indexSeq
+
+            tasks = yield self._db.active_tasks()
+            if 'error' in tasks:
+                raise DesignDocError(tasks)
+
+            tasks = [t for t in tasks if t.get('type') == 'indexer' and t.get('design_document') == id and self._isDatabase(t.get('database'))]
+            if len(tasks) > 0:
+                self._progress[id] = self._estimate(tasks)
+            else:
+                self._progress[id] = self._estimateFromSeq(startedOn, startSeq, indexSeq, targetSeq)
+
+            if progress:
+                progress(id, self._progress[id])
+
+            yield task.deferLater(reactor, self._pollInterval, lambda: None)
+
+        self._progress[id] = {'progress': 100, 'changes_done': indexSeq, 'total_changes': targetSeq, 'eta': 0}
+        if progress:
+            progress(id, self._progress[id])
+
+    def _isDatabase(self, database):
+        # CouchDB 2.x reports one task per shard, e.g. "shards/00000000-1fffffff/name.1234567"
+        if database == None: return False
+        name = self._db.name()
+        return database == name or (database.startswith('shards/') and database.split('/')[-1].split('.')[0] == name)
+
+    def _estimate(self, tasks):
+        done = sum(t.get('changes_done', 0) for t in tasks)
+        total = sum(t.get('total_changes', 0) for t in tasks)
+        started = min(t.get('started_on', 0) for t in tasks)
+        updated = max(t.get('updated_on', started) for t in tasks)
+
+        eta = None
+        if done > 0 and updated > started:
+            rate = float(done) / (updated - started)
+            eta = (total - done) / rate
+
+        percent = 0
+        if total > 0:
+            percent = done * 100 / total
+
+        return {'progress': percent, 'changes_done': done, 'total_changes': total, 'eta': eta}
+
+    def _estimateFromSeq(self, startedOn, startSeq, indexSeq, targetSeq):
+        # while the indexer is not listed in _active_tasks, judge by the index update_seq
+        done = indexSeq - startSeq
+        total = targetSeq - startSeq
+
+        eta = None
+        elapsed = time.time() - startedOn
+        if done > 0 and elapsed > 0:
+            eta = (total - done) / (done / elapsed)
+
+        percent = 0
+        if targetSeq > 0:
+            percent = indexSeq * 100 / targetSeq
+
+        return {'progress': percent, 'changes_done': indexSeq, 'total_changes': targetSeq, 'eta': eta}
+
+    def progress(self, id=None):
+        if id == None:
+            return self._progress
+
+        if not id.startswith('_design/'): id = '_design/' + id
+        return self._progress.get(id + self._stagingSuffix)
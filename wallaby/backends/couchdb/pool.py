@@ -0,0 +1,155 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer, threads
+import collections, zlib
+
+def seqNumber(seq):
+    # CouchDB 1.x uses integer sequences, 2.x uses "<number>-<opaque>" strings
+    if isinstance(seq, (int, long)): return seq
+
+    try:
+        return int(str(seq).split('-')[0])
+    except ValueError:
+        return None
+
+class ChangesConsumerPool(object):
+    def __init__(self, workers=4, maxPending=1000, threaded=False):
+        self._workers = workers
+        self._maxPending = maxPending
+        self._threaded = threaded
+
+        self._queues = [collections.deque() for i in range(workers)]
+        self._busy = [False] * workers
+        self._pending = 0
+
+        # [seq, done] entries in the order the changes were received
+        self._order = collections.deque()
+        self._receivedSeq = None
+        self._processedSeq = None
+        self._startSeq = None
+
+        self._transport = None
+        self._paused = False
+        self._stopped = False
+
+    def setTransport(self, transport, since=None):
+        if self._stopped:
+            # the pool is reused for a new changes feed
+            self._stopped = False
+            self._receivedSeq = None
+            self._processedSeq = None
+
+        if self._receivedSeq == None:
+            self._startSeq = seqNumber(since)
+
+        self._transport = transport
+        self._paused = False
+
+        if self._pending >= self._maxPending:
+            self._pause()
+
+    def put(self, change, callbacks, viewID=None):
+        if self._stopped: return
+
+        entry = [change.get('seq'), False]
+        self._order.append(entry)
+        self._receivedSeq = entry[0]
+        self._pending += 1
+
+        if self._startSeq == None and seqNumber(entry[0]) != None:
+            # the feed started right before its first change
+            self._startSeq = seqNumber(entry[0]) - 1
+
+        # all changes of one document go to the same worker to keep their order
+        worker = (zlib.crc32(str(change.get('id'))) & 0xffffffff) % self._workers
+        self._queues[worker].append((entry, list(callbacks), change, viewID))
+
+        if not self._busy[worker]:
+            self._busy[worker] = True
+            from twisted.internet import reactor
+            reactor.callLater(0, self._work, worker)
+
+        if self._pending >= self._maxPending:
+            self._pause()
+
+    @defer.inlineCallbacks
+    def _work(self, worker):
+        queue = self._queues[worker]
+
+        while len(queue) > 0 and not self._stopped:
+            entry, callbacks, change, viewID = queue.popleft()
+
+            try:
+                if self._threaded:
+                    yield threads.deferToThread(self._callAll, callbacks, change, viewID)
+                else:
+                    yield defer.gatherResults([defer.maybeDeferred(cb, change, viewID=viewID) for cb in callbacks], consumeErrors=True)
+            except Exception as e:
+                print "Exception in changes callback", viewID, change.get('id'), e
+
+            self._done(entry)
+
+        self._busy[worker] = False
+
+    def _callAll(self, callbacks, change, viewID):
+        for cb in callbacks:
+            cb(change, viewID=viewID)
+
+    def _done(self, entry):
+        # already flushed by stop()
+        if entry[1]: return
+
+        entry[1] = True
+        self._pending -= 1
+
+        while len(self._order) > 0 and self._order[0][1]:
+            self._processedSeq = self._order.popleft()[0]
+
+        if self._pending <= self._maxPending / 2:
+            self._resume()
+
+    def _pause(self):
+        if self._transport != None and not self._paused:
+            self._paused = True
+            self._transport.pauseProducing()
+
+    def _resume(self):
+        if self._transport != None and self._paused:
+            self._paused = False
+            self._transport.resumeProducing()
+
+    def stop(self):
+        self._stopped = True
+        for queue in self._queues:
+            queue.clear()
+
+        for entry in self._order:
+            entry[1] = True
+
+        self._pending = 0
+        self._order.clear()
+        self._resume()
+        self._transport = None
+
+    def pending(self):
+        return self._pending
+
+    def paused(self):
+        return self._paused
+
+    def receivedSeq(self):
+        return self._receivedSeq
+
+    def processedSeq(self):
+        return self._processedSeq
+
+    def lag(self):
+        # sequence distance, counted from the start of the feed until a change is processed
+        received = seqNumber(self._receivedSeq)
+        processed = seqNumber(self._processedSeq)
+
+        if processed == None: processed = self._startSeq
+        if received == None or processed == None: return 0
+
+        return received - processed
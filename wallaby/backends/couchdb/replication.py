@@ -0,0 +1,157 @@
+# Copyright (c) by it's authors.
+# Some rights reserved. See LICENSE, AUTHORS.
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+import urllib, json, hashlib
+
+from wallaby.backends.http import UnknownError
+from wallaby.backends.couchdb import JSONProducer
+
+class ReplicationError(UnknownError):
+    pass
+
+class Replicator(object):
+    def __init__(self, source, target, batchSize=500, parallel=4, checkpoint=True):
+        self._source = source
+        self._target = target
+        self._batchSize = batchSize
+        self._parallel = parallel
+        self._checkpoint = checkpoint
+        self._checkpointRev = None
+
+        self._stats = {
+            'last_seq': 0,
+            'docs_read': 0,
+            'docs_written': 0,
+            'missing_revs': 0,
+            'errors': 0
+        }
+
+    def replicationID(self):
+        return hashlib.md5(json.dumps([
+            self._source.url(), self._source.name(),
+            self._target.url(), self._target.name()
+        ])).hexdigest()
+
+    def stats(self):
+        return self._stats
+
+    def run(self):
+        d = defer.Deferred()
+
+        self._run(d)
+
+        return d
+
+    @defer.inlineCallbacks
+    def _run(self, d):
+        try:
+            since = 0
+            if self._checkpoint:
+                since = yield self._readCheckpoint()
+
+            while True:
+                query = urllib.urlencode({'since': since, 'limit': self._batchSize, 'style': 'all_docs'})
+                response = yield self._source.request('GET', path='_changes?'+query)
+
+                if 'error' in response:
+                    raise ReplicationError(response)
+
+                if len(response['results']) > 0:
+                    yield self._replicateBatch(response['results'])
+
+                since = response['last_seq']
+                self._stats['last_seq'] = since
+
+                if self._checkpoint:
+                    yield self._writeCheckpoint(since)
+
+                if len(response['results']) < self._batchSize:
+                    break
+
+            d.callback(self._stats)
+        except (Exception,Failure) as e:
+            d.errback(e)
+
+    @defer.inlineCallbacks
+    def _replicateBatch(self, changes):
+        revs = {}
+        for change in changes:
+            revs[change['id']] = [c['rev'] for c in change['changes']]
+
+        # ask the target which revisions it does not know yet
+        diff = yield self._target.request('POST', path='_revs_diff', headers={'Content-Type': ['application/json']}, body=JSONProducer(revs))
+
+        if 'error' in diff:
+            raise ReplicationError(diff)
+
+        missing = []
+        for id, entry in diff.items():
+            for rev in entry.get('missing', []):
+                missing.append({'id': id, 'rev': rev})
+
+        self._stats['missing_revs'] += len(missing)
+
+        if len(missing) == 0: return
+
+        chunkSize = (len(missing) + self._parallel - 1) / self._parallel
+        chunks = [missing[i:i+chunkSize] for i in range(0, len(missing), chunkSize)]
+
+        try:
+            yield defer.gatherResults([self._copy(chunk) for chunk in chunks], consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+
+    @defer.inlineCallbacks
+    def _copy(self, revs):
+        response = yield self._source.request('POST', path='_bulk_get?revs=true&attachments=true',
+            headers={'Content-Type': ['application/json'], 'Accept': ['application/json']},
+            body=JSONProducer({'docs': revs}))
+
+        if 'error' in response:
+            raise ReplicationError(response)
+
+        docs = []
+        for result in response['results']:
+            for entry in result['docs']:
+                if 'ok' in entry:
+                    docs.append(entry['ok'])
+                else:
+                    self._stats['errors'] += 1
+
+        self._stats['docs_read'] += len(docs)
+
+        # new_edits=false stores the revisions with their original history
+        response = yield self._target.request('POST', path='_bulk_docs', headers={'Content-Type': ['application/json']},
+            body=JSONProducer({'docs': docs, 'new_edits': False}))
+
+        if 'error' in response:
+            raise ReplicationError(response)
+
+        errors = len([r for r in response if 'error' in r])
+        self._stats['errors'] += errors
+        self._stats['docs_written'] += len(docs) - errors
+
+    @defer.inlineCallbacks
+    def _readCheckpoint(self):
+        response = yield self._target.request('GET', path='_local/'+self.replicationID())
+
+        if 'error' in response:
+            defer.returnValue(0)
+
+        self._checkpointRev = response['_rev']
+        defer.returnValue(response['source_last_seq'])
+
+    @defer.inlineCallbacks
+    def _writeCheckpoint(self, since):
+        doc = {'_id': '_local/'+self.replicationID(), 'source_last_seq': since}
+        if self._checkpointRev != None:
+            doc['_rev'] = self._checkpointRev
+
+        response = yield self._target.request('PUT', path=doc['_id'], body=JSONProducer(doc))
+
+        if 'error' in response:
+            raise ReplicationError(response)
+
+        self._checkpointRev = response['rev']